@@ -2,15 +2,21 @@
 Flywheel api class
 """
 from __future__ import annotations
+import hashlib
 import typing as ty
+import asyncio
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import attrs
+from requests.adapters import HTTPAdapter
 from fileformats.core import FileSet
 from arcana.core.data.store import RemoteStore
 from arcana.core.data.row import DataRow
 from arcana.core.data.tree import DataTree
 from arcana.core.data.entry import DataEntry
 
+from arcana.core.exceptions import ArcanaNameError
 from arcana.common import Clinical
 
 import flywheel
@@ -21,8 +27,11 @@ import logging
 
 logger = logging.getLogger("arcana")
 
+# Reciprocal of the number of seconds in a year, used to convert session ages
+_INV_YEAR = 1.0 / 31536000.0
 
-@attrs.define(kw_only=True, slots=False)
+
+@attrs.define(kw_only=True, slots=True)
 class Flywheel(RemoteStore):
     """
     Access class for Flywheel data repositores
@@ -44,6 +53,23 @@ class Flywheel(RemoteStore):
     # DEFAULT_SPACE = Clinical
     # DEFAULT_HIERARCHY = ["subject", "timepoint"]
 
+    # Maximum number of concurrent requests made to the server
+    MAX_WORKERS = 32
+
+    # Flywheel containers cached for the lifetime of the connection to avoid
+    # repeated requests to the server
+    _lookup_cache: dict[str, ty.Any] = attrs.field(
+        factory=dict, init=False, repr=False, eq=False
+    )
+    _row_cache: dict[tuple[str, ...], ty.Any] = attrs.field(
+        factory=dict, init=False, repr=False, eq=False
+    )
+    # Flywheel client reused between connections so its pool of HTTP connections
+    # can be kept alive
+    _client: ty.Optional[flywheel.Client] = attrs.field(
+        default=None, init=False, repr=False, eq=False
+    )
+
     #############################
     # DataStore abstractmethods #
     #############################
@@ -64,25 +90,32 @@ class Flywheel(RemoteStore):
         """
 
         with self.connection:
-            logger.debug(f"DATASET ID: {tree.dataset_id}")
-            fwproject = self.connection.lookup(f"arcana_tests/{tree.dataset_id}")
-            subjects = sorted(fwproject.subjects(), key=lambda x: x.label)
-            for fwsubject in subjects:
-                fwsessions = sorted(
-                    fwsubject.sessions(),
-                    key=lambda x: x.timestamp,
-                )
-                for fwsess in fwsessions:
-                    date = fwsess.date.strftime("%Y%m%d") if fwsess.timestamp else None
-                    metadata = {
-                        "session": {
-                            "date": date,
-                            "age": fwsess.age / 31536000
-                            if fwsess.age is not None
-                            else -1,
-                        }
-                    }
-                    tree.add_leaf([fwsubject.label, fwsess.label], metadata=metadata)
+            logger.debug("DATASET ID: %s", tree.dataset_id)
+            leaves = self.list_leaves(tree.dataset_id)
+        for tree_path, metadata in leaves:
+            tree.add_leaf(tree_path, metadata=metadata)
+
+    async def apopulate_tree(self, tree: DataTree):
+        """Asynchronous version of ``populate_tree``. The requests to the server are
+        made in a worker thread so the event loop is free to run other tasks (e.g.
+        populating the trees of other datasets) while waiting on them
+
+        Parameters
+        ----------
+        tree : DataTree
+            the data tree to populate with leaf nodes
+        """
+        loop = asyncio.get_running_loop()
+        with self.connection:
+            logger.debug("DATASET ID: %s", tree.dataset_id)
+            fwproject = self.lookup_fwcontainer(f"arcana_tests/{tree.dataset_id}")
+            # Only the requests that don't touch the connection context are made in
+            # the worker thread
+            leaves = await loop.run_in_executor(
+                None, self._list_fwproject_leaves, fwproject
+            )
+        for tree_path, metadata in leaves:
+            tree.add_leaf(tree_path, metadata=metadata)
 
     def populate_row(self, row: DataRow):
         """Scans a node in the data tree corresponding to the data row and populates a
@@ -154,9 +187,25 @@ class Flywheel(RemoteStore):
             the session object returned by `connect` to be closed gracefully
         """
 
-        # Flywheel Client is not designed to be a context manager
-        return flywheel.Client()
-        # raise NotImplementedError
+        # Flywheel Client is not designed to be a context manager. Nested
+        # `with self.connection` blocks are reference counted by the connection
+        # manager, so this is only called on entry to the outermost block, and the
+        # same client is returned each time so it is only authenticated once
+        if self._client is None:
+            client = flywheel.Client()
+            # Enlarge the connection pools of the client's HTTP session so that
+            # concurrent requests don't have to open new connections, keeping the
+            # retry settings of the adapters they replace
+            session = client.api_client.rest_client.session
+            for prefix, adapter in list(session.adapters.items()):
+                session.mount(
+                    prefix,
+                    HTTPAdapter(
+                        pool_maxsize=self.MAX_WORKERS, max_retries=adapter.max_retries
+                    ),
+                )
+            self._client = client
+        return self._client
 
     def disconnect(self, session):
         """
@@ -167,7 +216,23 @@ class Flywheel(RemoteStore):
         session : Any
             the session object returned by `connect` to be closed gracefully
         """
-        # raise NotImplementedError
+        # Cached containers are only valid for the lifetime of the connection
+        self._lookup_cache.clear()
+        self._row_cache.clear()
+        # Release the pooled HTTP connections, they are reopened on the next request
+        session.api_client.rest_client.session.close()
+
+    def __getstate__(self):
+        # The client and the containers retrieved with it hold locks and so can't be
+        # pickled (e.g. when the store is passed to pydra workers), so they are left
+        # out and the client is recreated on the next connection
+        state = {f.name: getattr(self, f.name) for f in attrs.fields(type(self))}
+        state.update(_client=None, _lookup_cache={}, _row_cache={})
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
 
     def get_provenance(self, entry: DataEntry) -> dict[str, ty.Any]:
         """Retrieves provenance information for a given data entry in the store
@@ -229,21 +294,35 @@ class Flywheel(RemoteStore):
             Not used, but should be kept here to allow compatibility with future
             stores that may need to be passed other arguments
         """
+        self._row_cache = {k: v for k, v in self._row_cache.items() if k[0] != id}
         with self.connection:
 
+            debug = logger.isEnabledFor(logging.DEBUG)
             group = self.connection.get("arcana_tests")
             project = group.add_project(label=id)
-            for ids_tuple in leaves:
-                logger.debug(ids_tuple)
-                subject_id, session_id = ids_tuple
+            self._lookup_cache[f"arcana_tests/{id}"] = project
+
+            def add_subject(subject_id):
+                # Sessions are created one at a time, in the order they appear in
+                # the leaves, so they are stored in the same order
                 try:
-                    # Create subject
-                    subject = project.add_subject(label=f"{subject_id}")
-                except flywheel.ApiException:
-                    # subject already exists
-                    continue
-                # Create session
-                subject.add_session(label=f"{session_id}")
+                    fwsubject = fwsubjects[subject_id]
+                except KeyError:
+                    fwsubject = project.add_subject(label=f"{subject_id}")
+                for session_id in session_ids[subject_id]:
+                    if debug:
+                        logger.debug((subject_id, session_id))
+                    fwsubject.add_session(label=f"{session_id}")
+
+            # Retrieve any existing subjects (paginated, so none are missed) so that
+            # only the missing ones are created, then create each subject and its
+            # sessions, issuing the requests for different subjects concurrently
+            fwsubjects = {s.label: s for s in project.subjects.iter()}
+            session_ids = defaultdict(list)
+            for subject_id, session_id in leaves:
+                session_ids[subject_id].append(session_id)
+            with self._executor(len(session_ids)) as executor:
+                list(executor.map(add_subject, session_ids))
 
     ################################
     # RemoteStore-specific methods #
@@ -270,7 +349,19 @@ class Flywheel(RemoteStore):
         output_dir : Path
             a directory containing the downloaded files/directories and nothing else
         """
-        raise NotImplementedError
+
+        def download(fwfile):
+            fwcontainer.download_file(fwfile.name, str(output_dir / fwfile.name))
+
+        output_dir = download_dir / "files"
+        output_dir.mkdir()
+        with self.connection:
+            # Files of analyses and acquisitions are downloaded in the same way
+            fwcontainer = self.connection.get(entry.uri)
+            fwfiles = fwcontainer.files
+            with self._executor(len(fwfiles)) as executor:
+                list(executor.map(download, fwfiles))
+        return output_dir
 
     def upload_files(self, cache_path: Path, entry: DataEntry):
         """Upload all files contained within `input_dir` to the specified entry in the
@@ -283,13 +374,31 @@ class Flywheel(RemoteStore):
         entry : DataEntry
             the entry in the data store to upload the files to
         """
+        self.upload_files_bulk([(cache_path, entry)])
 
-        if "@" in entry.uri:
-            analysis = self.connection.get(entry.uri)
-            analysis.upload_output(cache_path)
-        else:
-            acquisition = self.connection.get(entry.uri)
-            acquisition.upload_file(cache_path)
+    def upload_files_bulk(self, uploads: list[tuple[Path, DataEntry]]):
+        """Upload the files for multiple entries in the data store, resolving the
+        Flywheel containers of the entries and uploading the files concurrently
+
+        Parameters
+        ----------
+        uploads : list[tuple[Path, DataEntry]]
+            pairs of the path to the files to be uploaded and the entry in the data
+            store to upload them to
+        """
+
+        def upload(cache_path_and_entry):
+            cache_path, entry = cache_path_and_entry
+            fwcontainer = fwcontainers[entry.uri]
+            if "@" in entry.uri:
+                fwcontainer.upload_output(cache_path)  # analysis
+            else:
+                fwcontainer.upload_file(cache_path)  # acquisition
+
+        uris = list(dict.fromkeys(entry.uri for _, entry in uploads))
+        with self.connection, self._executor(len(uploads)) as executor:
+            fwcontainers = dict(zip(uris, executor.map(self.connection.get, uris)))
+            list(executor.map(upload, uploads))
 
     def download_value(
         self, entry: DataEntry
@@ -426,25 +535,206 @@ class Flywheel(RemoteStore):
             the checksums calculated from the local file-set. Keys are the
             paths of the files and the values are the checksums of their contents
         """
-        raise NotImplementedError
+        # The keys follow the convention of ``FileSet.hash_files``. The chunk
+        # iterators are lazy, so the files are only read when they are hashed
+        # (in parallel in threads, as hashlib releases the GIL while hashing)
+        keys_and_chunks = list(
+            fileset.byte_chunks(relative_to=fileset.parent, chunk_len=2**20)
+        )
+        with self._executor(len(keys_and_chunks)) as executor:
+            return dict(
+                zip(
+                    (k for k, _ in keys_and_chunks),
+                    executor.map(hash_chunks, (c for _, c in keys_and_chunks)),
+                )
+            )
 
     ##################
     # Helper methods #
     ##################
 
+    def list_leaves(
+        self, dataset_id: str
+    ) -> list[tuple[list[str], dict[str, dict[str, ty.Any]]]]:
+        """Lists the leaves of the data tree of the dataset, along with the metadata
+        used to infer the IDs of rows not present in its hierarchy, in the order
+        they should be added to the tree
+
+        Parameters
+        ----------
+        dataset_id : str
+            the ID of the dataset (i.e. Flywheel project label)
+
+        Returns
+        -------
+        leaves : list[tuple[list[str], dict[str, dict[str, Any]]]]
+            the tree path and metadata of each leaf to pass to ``DataTree.add_leaf``
+        """
+        with self.connection:
+            fwproject = self.lookup_fwcontainer(f"arcana_tests/{dataset_id}")
+            return self._list_fwproject_leaves(fwproject)
+
+    def _list_fwproject_leaves(
+        self, fwproject: flywheel.Project
+    ) -> list[tuple[list[str], dict[str, dict[str, ty.Any]]]]:
+        """Lists the leaves of the data tree of a Flywheel project (see
+        ``list_leaves``). Doesn't enter the connection context, which isn't
+        thread-safe, so can be called from worker threads while the caller holds it
+
+        Parameters
+        ----------
+        fwproject : flywheel.Project
+            the Flywheel project to list the leaves of
+
+        Returns
+        -------
+        leaves : list[tuple[list[str], dict[str, dict[str, Any]]]]
+            the tree path and metadata of each leaf to pass to ``DataTree.add_leaf``
+        """
+        leaves = []
+        # Stream all sessions in the project, which carry the label of their
+        # subject, instead of listing the subjects and then their sessions, and
+        # group them by subject. The sessions are sorted by the server so they
+        # are already in order within each group. Timestamps aren't unique (or
+        # even set), so the label and ID are used to break ties, keeping the
+        # order deterministic and the page-based pagination stable
+        sessions_per_subject = defaultdict(list)
+        for fwsess in fwproject.sessions.iter_find(
+            sort="timestamp:asc,label:asc,_id:asc"
+        ):
+            sessions_per_subject[fwsess.subject.label].append(fwsess)
+        for subject_label in sorted(sessions_per_subject):
+            for fwsess in sessions_per_subject[subject_label]:
+                timestamp = fwsess.timestamp
+                date = (
+                    f"{timestamp.year:04d}{timestamp.month:02d}{timestamp.day:02d}"
+                    if timestamp
+                    else None
+                )
+                metadata = {
+                    "session": {
+                        "date": date,
+                        "age": fwsess.age * _INV_YEAR if fwsess.age is not None else -1,
+                    }
+                }
+                leaves.append(([subject_label, fwsess.label], metadata))
+        return leaves
+
+    def lookup_fwcontainer(self, path: str):
+        """Looks up a Flywheel container by its path, caching the result until the
+        connection to the store is closed
+
+        Parameters
+        ----------
+        path : str
+            the path to the container, e.g. "<group>/<project>/<subject>"
+
+        Returns
+        -------
+        fwcontainer : flywheel.Group or flywheel.Project or flywheel.Subject or ...
+            the Flywheel container at the given path
+        """
+        try:
+            fwcontainer = self._lookup_cache[path]
+        except KeyError:
+            fwcontainer = self._lookup_cache[path] = self.connection.lookup(path)
+        return fwcontainer
+
     def get_fwrow(self, row: DataRow):
-        """ """
+        """Retrieves the Flywheel container corresponding to the given row. The first
+        time a row of a given frequency is requested, the containers of all its
+        siblings are listed together and cached
+
+        Parameters
+        ----------
+        row : DataRow
+            the row to retrieve the Flywheel container for
+
+        Returns
+        -------
+        fwrow : flywheel.Project or flywheel.Subject or flywheel.Session
+            the Flywheel container corresponding to the row
+
+        Raises
+        ------
+        ArcanaNameError
+            if there is no container corresponding to the row in the project
+        """
 
         with self.connection:
-            fwproject = self.connection.lookup(f"arcana_tests/{row.dataset.id}")
-            # Check level in hierarchy
+            fwproject = self.lookup_fwcontainer(f"arcana_tests/{row.dataset.id}")
+            # Check level in hierarchy. Session labels are only unique within a
+            # subject, so sessions are cached by the labels of both
             if row.frequency == Clinical.dataset:
-                fwrow = fwproject
+                return fwproject
             elif row.frequency == Clinical.subject:
-                fwrow = fwproject.get(row.frequency_id("subject"))
+                key = (row.dataset.id, row.frequency_id("subject"))
+                fwsiblings = fwproject.subjects
+
+                def sibling_key(fwsubject):
+                    return (row.dataset.id, fwsubject.label)
+
             elif row.frequency == Clinical.session:
-                fwrow = fwproject.get(row.frequency_id("session"))
+                key = (
+                    row.dataset.id,
+                    row.frequency_id("subject"),
+                    row.frequency_id("session"),
+                )
+                fwsiblings = fwproject.sessions
+
+                def sibling_key(fwsess):
+                    return (row.dataset.id, fwsess.subject.label, fwsess.label)
+
             else:
                 raise NotImplementedError
+            try:
+                fwrow = self._row_cache[key]
+            except KeyError:
+                for fwsibling in fwsiblings.iter():
+                    self._row_cache[sibling_key(fwsibling)] = fwsibling
+                try:
+                    fwrow = self._row_cache[key]
+                except KeyError:
+                    raise ArcanaNameError(
+                        key[-1],
+                        f"Did not find {row.frequency} '{'/'.join(key[1:])}' in "
+                        f"Flywheel project '{row.dataset.id}'",
+                    )
 
             return fwrow
+
+    def _executor(self, n_tasks: int) -> ThreadPoolExecutor:
+        """Creates a thread pool to run the given number of concurrent tasks in,
+        capped at MAX_WORKERS threads
+
+        Parameters
+        ----------
+        n_tasks : int
+            the number of tasks to be run in the pool
+
+        Returns
+        -------
+        executor : ThreadPoolExecutor
+            the thread pool, to be used as a context manager
+        """
+        return ThreadPoolExecutor(max_workers=max(min(self.MAX_WORKERS, n_tasks), 1))
+
+
+def hash_chunks(chunks: ty.Iterable[bytes]) -> str:
+    """Calculates the SHA-384 digest of a file from its contents, the algorithm
+    Flywheel uses for the hashes of the files it stores
+
+    Parameters
+    ----------
+    chunks : Iterable[bytes]
+        the contents of the file in chunks
+
+    Returns
+    -------
+    digest : str
+        the hexadecimal digest of the file's contents
+    """
+    crypto_obj = hashlib.sha384()
+    for chunk in chunks:
+        crypto_obj.update(chunk)
+    return crypto_obj.hexdigest()
@@ -0,0 +1,247 @@
+import asyncio
+import copy
+import hashlib
+import pickle
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import flywheel
+from fileformats.generic import File, Directory
+from arcana.common import Clinical
+from arcana.core.exceptions import ArcanaNameError
+from arcana.flywheel.data import Flywheel
+
+
+@pytest.fixture
+def fwclient():
+    return MagicMock()
+
+
+@pytest.fixture
+def store(work_dir, fwclient):
+    cache_dir = work_dir / "remote-cache"
+    cache_dir.mkdir()
+    with patch.object(Flywheel, "connect", return_value=fwclient):
+        yield Flywheel(server="dummy", cache_dir=cache_dir)
+
+
+def make_fwsession(subject_label, label, **kwargs):
+    return SimpleNamespace(
+        subject=SimpleNamespace(label=subject_label), label=label, **kwargs
+    )
+
+
+def make_row(dataset_id, frequency, **ids):
+    return SimpleNamespace(
+        dataset=SimpleNamespace(id=dataset_id),
+        frequency=frequency,
+        frequency_id=ids.__getitem__,
+    )
+
+
+def test_get_fwrow_session_labels_repeated_across_subjects(store, fwclient):
+    fwsessions = [
+        make_fwsession("subjA", "MR01"),
+        make_fwsession("subjB", "MR01"),
+    ]
+    fwproject = fwclient.lookup.return_value
+    fwproject.sessions.iter.return_value = fwsessions
+    row = make_row("proj", Clinical.session, subject="subjA", session="MR01")
+    assert store.get_fwrow(row) is fwsessions[0]
+    row = make_row("proj", Clinical.session, subject="subjB", session="MR01")
+    assert store.get_fwrow(row) is fwsessions[1]
+
+
+def test_get_fwrow_missing(store, fwclient):
+    fwproject = fwclient.lookup.return_value
+    fwproject.subjects.iter.return_value = [SimpleNamespace(label="subjA")]
+    row = make_row("proj", Clinical.subject, subject="label")
+    with pytest.raises(ArcanaNameError):
+        store.get_fwrow(row)
+    fwproject.get.assert_not_called()
+
+
+def test_create_data_tree_session_order(store, fwclient):
+    fwproject = fwclient.get.return_value.add_project.return_value
+    fwproject.subjects.iter.return_value = []
+    fwsubjects = {}
+
+    def add_subject(label):
+        fwsubjects[label] = MagicMock()
+        return fwsubjects[label]
+
+    fwproject.add_subject.side_effect = add_subject
+    leaves = [(f"subj{i}", f"sess{j}") for i in range(1, 6) for j in range(10, 0, -1)]
+    store.create_data_tree("proj", leaves, space=Clinical, hierarchy=[])
+    assert sorted(fwsubjects) == [f"subj{i}" for i in range(1, 6)]
+    for fwsubject in fwsubjects.values():
+        assert [c.kwargs["label"] for c in fwsubject.add_session.call_args_list] == [
+            f"sess{j}" for j in range(10, 0, -1)
+        ]
+
+
+def test_list_leaves(store, fwclient):
+    fwsessions = [
+        make_fwsession("subjB", "MR01", timestamp=None, age=None),
+        make_fwsession(
+            "subjA", "MR01", timestamp=datetime(2020, 1, 2), age=31536000 * 2
+        ),
+    ]
+    fwproject = fwclient.lookup.return_value
+    fwproject.sessions.iter_find.return_value = fwsessions
+    assert store.list_leaves("proj") == [
+        (["subjA", "MR01"], {"session": {"date": "20200102", "age": 2.0}}),
+        (["subjB", "MR01"], {"session": {"date": None, "age": -1}}),
+    ]
+
+
+def test_list_leaves_sees_changes_within_connection(store, fwclient):
+    fwsessions = [make_fwsession("subjA", "MR01", timestamp=None, age=None)]
+    fwproject = fwclient.lookup.return_value
+    fwproject.sessions.iter_find.side_effect = lambda **_: list(fwsessions)
+    with store.connection:
+        assert len(store.list_leaves("proj")) == 1
+        fwsessions.append(make_fwsession("subjA", "MR02", timestamp=None, age=None))
+        assert len(store.list_leaves("proj")) == 2
+
+
+def test_apopulate_tree(store, fwclient):
+    fwproject = fwclient.lookup.return_value
+    fwproject.sessions.iter_find.return_value = [
+        make_fwsession("subjA", "MR01", timestamp=None, age=None)
+    ]
+    trees = [MagicMock(dataset_id=f"proj{i}") for i in range(5)]
+
+    async def populate_trees():
+        await asyncio.gather(*(store.apopulate_tree(t) for t in trees))
+
+    asyncio.run(populate_trees())
+    for tree in trees:
+        tree.add_leaf.assert_called_once_with(
+            ["subjA", "MR01"], metadata={"session": {"date": None, "age": -1}}
+        )
+    assert store.connection.depth == 0
+    assert store.connection.session is None
+
+
+@pytest.mark.parametrize("n_files", [0, 3])
+def test_download_files(store, fwclient, work_dir, n_files):
+    fwcontainer = fwclient.get.return_value
+    fwcontainer.files = [SimpleNamespace(name=f"file{i}.txt") for i in range(n_files)]
+    fwcontainer.download_file.side_effect = lambda n, p: Path(p).write_text(n)
+    download_dir = work_dir / "download"
+    download_dir.mkdir()
+    entry = SimpleNamespace(uri="/acquisitions/123")
+    output_dir = store.download_files(entry, download_dir)
+    assert output_dir == download_dir / "files"
+    fwclient.get.assert_called_once_with("/acquisitions/123")
+    assert sorted(p.name for p in output_dir.iterdir()) == [
+        f"file{i}.txt" for i in range(n_files)
+    ]
+
+
+def test_upload_files_bulk(store, fwclient):
+    fwcontainers = {}
+
+    def get(uri):
+        fwcontainers[uri] = MagicMock()
+        return fwcontainers[uri]
+
+    fwclient.get.side_effect = get
+    uploads = [
+        (Path("a.nii"), SimpleNamespace(uri="/acquisitions/1")),
+        (Path("b.nii"), SimpleNamespace(uri="/acquisitions/1")),
+        (Path("c.nii"), SimpleNamespace(uri="/analyses/2@out")),
+    ]
+    store.upload_files_bulk(uploads)
+    assert sorted(c.args[0] for c in fwclient.get.call_args_list) == [
+        "/acquisitions/1",
+        "/analyses/2@out",
+    ]
+    acquisition = fwcontainers["/acquisitions/1"]
+    assert sorted(c.args[0] for c in acquisition.upload_file.call_args_list) == [
+        Path("a.nii"),
+        Path("b.nii"),
+    ]
+    acquisition.upload_output.assert_not_called()
+    analysis = fwcontainers["/analyses/2@out"]
+    analysis.upload_output.assert_called_once_with(Path("c.nii"))
+    analysis.upload_file.assert_not_called()
+
+
+def test_upload_files(store):
+    entry = SimpleNamespace(uri="/acquisitions/1")
+    with patch.object(Flywheel, "upload_files_bulk") as upload_files_bulk:
+        store.upload_files(Path("a.nii"), entry)
+    upload_files_bulk.assert_called_once_with([(Path("a.nii"), entry)])
+
+
+def test_calculate_checksums_file(store, work_dir):
+    fspath = work_dir / "file.txt"
+    fspath.write_bytes(b"contents" * 100000)
+    checksums = store.calculate_checksums(File(fspath))
+    assert checksums == {"file.txt": hashlib.sha384(fspath.read_bytes()).hexdigest()}
+
+
+def test_calculate_checksums_nested_dir(store, work_dir):
+    dpath = work_dir / "dir1"
+    (dpath / "sub").mkdir(parents=True)
+    (dpath / "a.txt").write_text("a")
+    (dpath / "sub" / "b.txt").write_text("b")
+    fileset = Directory(dpath)
+    checksums = store.calculate_checksums(fileset)
+    assert checksums == {
+        "dir1/a.txt": hashlib.sha384(b"a").hexdigest(),
+        "dir1/sub/b.txt": hashlib.sha384(b"b").hexdigest(),
+    }
+    assert checksums == fileset.hash_files(
+        crypto=hashlib.sha384, relative_to=fileset.parent
+    )
+
+
+@pytest.fixture
+def mock_fwclient_cls():
+    def make_client():
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=3)))
+        session.mount("http://", HTTPAdapter(max_retries=Retry(total=3)))
+        fwclient = MagicMock()
+        fwclient.api_client.rest_client.session = session
+        return fwclient
+
+    with patch.object(flywheel, "Client", side_effect=make_client) as fwclient_cls:
+        yield fwclient_cls
+
+
+def test_connect(work_dir, mock_fwclient_cls):
+    store = Flywheel(server="dummy", cache_dir=work_dir)
+    with store.connection:
+        fwclient = store.connection.session
+        with store.connection:
+            assert store.connection.session is fwclient
+    with store.connection:
+        assert store.connection.session is fwclient
+    mock_fwclient_cls.assert_called_once()
+    adapters = fwclient.api_client.rest_client.session.adapters
+    assert sorted(adapters) == ["http://", "https://"]
+    for adapter in adapters.values():
+        assert adapter._pool_maxsize == Flywheel.MAX_WORKERS
+        assert adapter.max_retries.total == 3
+
+
+def test_pickle_after_connection(work_dir, mock_fwclient_cls):
+    store = Flywheel(server="dummy", cache_dir=work_dir)
+    with store.connection:
+        store.lookup_fwcontainer("arcana_tests/proj")
+    for copied in (pickle.loads(pickle.dumps(store)), copy.deepcopy(store)):
+        assert copied.server == "dummy"
+        assert copied.cache_dir == store.cache_dir
+        with copied.connection:
+            assert copied.connection.session is not store._client
+            copied.lookup_fwcontainer("arcana_tests/proj")
+            copied.connection.lookup.assert_called_once_with("arcana_tests/proj")